@@ -5,12 +5,15 @@ from typing import Self
 class Action(ABC):
     """Represent a generic possible action a player can do in a game."""
 
+    # Allow subclasses to get rid of the per-instance __dict__ by declaring their own __slots__
+    __slots__ = ()
+
     @abstractmethod
     def __eq__(self: Self, other: Self) -> bool:
         """Test equality between two Actions."""
-        raise pass
+        pass
 
     @abstractmethod
     def __hash__(self: Self) -> int:
         """Return a unique hash value for this Action."""
-        raise pass
+        pass
@@ -1,8 +1,16 @@
 from abc import ABC, abstractmethod
+from collections.abc import Callable
+from random import Random
 from typing import Optional, Self
 
 from action import Action
 
+# Random generator used by the rollouts. It is a dedicated instance so that it can be seeded on its
+#   own, and its _randbelow method is bound once since it is called at every step of the rollouts.
+#   Unlike randrange or choice, it doesn't check its argument
+_rng = Random()
+randbelow: Callable[[int], int] = _rng._randbelow
+
 
 class GameState(ABC):
     """Abstract class to represent a game state.
@@ -12,6 +20,9 @@ class GameState(ABC):
     numbers, while the other one would have their pieces represented by negative numbers.
     """
 
+    # Subclasses may declare their own __slots__, there is then no per-instance __dict__ at all
+    __slots__ = ("_actions", "_winner")
+
     @abstractmethod
     def get_winner(self: Self) -> Optional[float]:
         """Return the winner of the game, if it exists.
@@ -23,12 +34,85 @@ class GameState(ABC):
         """
         pass
 
+    @property
+    def winner(self: Self) -> Optional[float]:
+        """Return the winner of the game as in `get_winner`, computing it only the first time."""
+        try:
+            return self._winner
+        except AttributeError:
+            self._winner = self.get_winner()
+            return self._winner
+
     @abstractmethod
     def get_possible_actions(self: Self) -> list[Action]:
         """Return the list of possible actions when playing this game state."""
         pass
 
+    @property
+    def actions(self: Self) -> list[Action]:
+        """Return the list of possible actions, computing it only the first time.
+
+        Game states are never modified once created, so the actions can safely be reused by every
+        phase of the MCTS going through this state.
+        """
+        try:
+            return self._actions
+        except AttributeError:
+            self._actions = self.get_possible_actions()
+            return self._actions
+
     @abstractmethod
     def transition(self: Self, action: Action) -> Self:
         """Return the new game state resulting from a given action applied on the current state."""
         pass
+
+    def rollout(self: Self) -> int:
+        """Randomly select moves until a terminal game state is reached from this state.
+
+        Once such a state has been reached, this function will return:
+        - 1 if it resulted in a win for the player playing this position;
+        - -1 if it resulted in a loss for the player playing this position;
+        - 0 if it resulted in a draw.
+
+        Games can override this function with a faster implementation working directly on their
+        internal representation.
+        """
+        new_state = self
+        player = 1
+
+        while (winner := new_state.winner) is None:
+            actions = new_state.actions
+            new_state = new_state.transition(actions[randbelow(len(actions))])
+            player *= -1
+
+        return winner * player
+
+    @classmethod
+    def rollout_batch(cls: type(Self), states: list[Self]) -> list[int]:
+        """Perform a rollout from each of the given states.
+
+        Games can override this function to perform all the rollouts at once.
+        """
+        return [state.rollout() for state in states]
+
+    @classmethod
+    def seed_rollouts(cls: type(Self), value: int) -> None:
+        """Seed the random generators used by the rollouts.
+
+        Games whose rollouts rely on another generator should override this function.
+        """
+        _rng.seed(value)
+
+    def search(self: Self, trade_off_constant: float, n_simulations: int) -> Optional[list[int]]:
+        """Run a whole MCTS from this state with a specialized implementation, if the game has one.
+
+        Games can override this function to run the search directly on their internal
+        representation, for instance with compiled code, instead of growing a tree of Python
+        objects.
+
+        :param trade_off_constant: The trade-off constant as used in the UCB formula.
+        :param n_simulations: The number of simulations that are performed from this state.
+        :return: The visits of each child of the root, in the order of `actions`, or None if the
+          game has no specialized implementation.
+        """
+        return None
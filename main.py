@@ -11,7 +11,7 @@ initial_state = np.array(
     ]
 )
 
-mcts_player = MCTS(TicTacToeGameState(initial_state), np.sqrt(2), 800)
+mcts_player = MCTS(TicTacToeGameState.from_board(initial_state), np.sqrt(2), 800)
 action = mcts_player.decide(advance=False)
 
 print(mcts_player.root_state.transition(action))
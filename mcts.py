@@ -1,36 +1,68 @@
-from math import sqrt, log
-from random import choice
+from array import array
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from math import inf, log, sqrt
+from random import getrandbits, seed
+from threading import Lock
 from typing import Self, Optional
 
-from tqdm import trange
+import numpy as np
+from tqdm import tqdm, trange
 
 from action import Action
-from game_state import GameState
+from game_state import GameState, randbelow
+
+# Number of children from which the UCB scores are computed with NumPy rather than in a Python loop.
+#   Below it, the fixed cost of the NumPy calls outweighs the per-child cost of the loop
+VECTORIZED_SELECTION_MIN_CHILDREN: int = 24
 
 
 class _Node:
     """Represent a node in the MCTS tree."""
 
-    # Constant that represents the exploration/exploitation trade-off
-    C: float = sqrt(2)
-
-    @classmethod
-    def set_trade_off_constant(cls: type(Self), value: float) -> None:
-        """Update the value of the exploration/exploitation trade-off constant."""
-        cls.C = value
-
-    def __init__(self: Self, parent: Optional[Self]) -> None:
+    # There can be millions of nodes in a tree, so get rid of the per-instance __dict__
+    __slots__ = (
+        "actions",
+        "child_net_wins",
+        "child_virtual_losses",
+        "child_visits",
+        "children",
+        "depth",
+        "index_in_parent",
+        "net_wins",
+        "parent",
+        "state",
+        "visits",
+    )
+
+    def __init__(self: Self, parent: Optional[Self], index_in_parent: int = 0) -> None:
         """Initialize the node.
 
         :param parent: Parent node in the MCTS tree.
+        :param index_in_parent: Index of this node in its parent's list of children.
         """
         self.parent: Optional[Self] = parent
+        self.index_in_parent: int = index_in_parent
+        # Depth at which the node was created. Transpositions are only linked to deeper nodes, so
+        #   that every edge goes deeper and the graph can't have cycles, even if positions repeat
+        self.depth: int = 0 if parent is None else parent.depth + 1
 
         self.children: list[_Node] = []
         self.actions: list[Action] = []
+        # Game state associated with this node, only computed once a simulation reaches it
+        self.state: Optional[GameState] = None
         self.visits: int = 0
-        self.n_wins: int = 0
-        self.n_defeats: int = 0
+        # Wins minus defeats, from the point of view of the player choosing this node
+        self.net_wins: int = 0
+
+        # Statistics of the children, stored contiguously as parallel arrays of 64-bit integers.
+        #   Unlike NumPy arrays, their items are read and updated one at a time without any
+        #   conversion, but NumPy can still view them to compute the UCB scores all at once. They
+        #   are only allocated when the node is expanded
+        self.child_visits: Optional[array] = None
+        # Wins minus defeats, which is all the UCB formula needs
+        self.child_net_wins: Optional[array] = None
+        self.child_virtual_losses: Optional[array] = None
 
     @property
     def value(self: Self) -> float:
@@ -38,46 +70,187 @@ class _Node:
         if self.visits == 0:
             return 0
 
-        return (self.n_wins - self.n_defeats) / self.visits
-
-    @property
-    def ucb(self: Self) -> float:
-        """Return the USB score of this Node."""
-        if self.visits == 0:
-            return float("inf")
-
-        # No need to check for the parent's visit count to be positive, since it is necessarily
-        # larger than that of its child
-        return self.value + self.C * sqrt(log(self.parent.visits) / self.visits)
+        return self.net_wins / self.visits
 
     @property
     def is_leaf(self: Self) -> bool:
         """Return True if this Node is a leaf node."""
         return len(self.children) == 0
 
-    def select_child(self: Self, state: GameState) -> tuple[Self, GameState]:
-        """Recursively select a leaf using the exploration/exploitation trade-off formula."""
-        if self.is_leaf:
-            return self, state
+    def reach_from(self: Self, parent: Self, index: int) -> None:
+        """Record that the current simulation reaches this node from a given parent.
+
+        Because of transpositions, a node may be the child of several parents. Its parent is the one
+        the last simulation came from, so that backpropagation follows the path that was actually
+        traversed.
 
-        best_child, best_action = max(
-            zip(self.children, self.actions),
-            key=lambda child_action: child_action[0].ucb,
-        )
+        :param parent: The node the simulation comes from.
+        :param index: Index of this node in the parent's list of children.
+        """
+        self.parent = parent
+        self.index_in_parent = index
+
+    def trace(self: Self) -> list[tuple[Self, Optional[Self], int]]:
+        """Return the path from this node to the root.
 
-        return best_child.select_child(state.transition(best_action))
+        Each element of the path is a node, along with its parent and its index in the parent's list
+        of children. The path can be restored with `restore` if a concurrent simulation went through
+        a transposition and changed the parent of one of its nodes in the meantime.
+        """
+        path = []
+        node = self
 
-    def expand(self: Self, state: GameState) -> tuple[Self, GameState]:
-        """Expand this Node by listing all the possible actions and randomly choose a child."""
+        while node is not None:
+            path.append((node, node.parent, node.index_in_parent))
+            node = node.parent
+
+        return path
+
+    @staticmethod
+    def restore(path: list[tuple[Self, Optional[Self], int]]) -> None:
+        """Restore the parents of the nodes along a path returned by `trace`."""
+        for node, parent, index in path:
+            node.parent = parent
+            node.index_in_parent = index
+
+    def child_state(self: Self, index: int, state: GameState) -> GameState:
+        """Return the game state of a child, computing it the first time it is reached.
+
+        :param index: Index of the child in this node's list of children.
+        :param state: The game state associated with this node.
+        """
+        child = self.children[index]
+
+        if child.state is None:
+            child.state = state.transition(self.actions[index])
+
+        return child.state
+
+    def best_child_index(self: Self, trade_off_constant: float) -> int:
+        """Return the index of the child to explore according to the UCB formula.
+
+        :param trade_off_constant: The exploration/exploitation trade-off constant.
+        """
+        # The parent's part of the exploration term is shared by all the children, so it is only
+        #   computed once
+        exploration = trade_off_constant * sqrt(log(max(self.visits, 1)))
+
+        if len(self.children) >= VECTORIZED_SELECTION_MIN_CHILDREN:
+            return self._best_child_index_vectorized(exploration)
+
+        best_index = 0
+        best_ucb = -inf
+
+        for index, (visits, net_wins, virtual_losses) in enumerate(
+            zip(self.child_visits, self.child_net_wins, self.child_virtual_losses)
+        ):
+            # Pending simulations count as lost visits, so that concurrent threads are steered
+            #   towards different children
+            visits += virtual_losses
+
+            # Unvisited children are always selected first
+            if visits == 0:
+                best_index = index
+                break
+
+            ucb = (net_wins - virtual_losses) / visits + exploration / sqrt(visits)
+
+            if ucb > best_ucb:
+                best_index = index
+                best_ucb = ucb
+
+        return best_index
+
+    def _best_child_index_vectorized(self: Self, exploration: float) -> int:
+        """Return the same index as `best_child_index`, computing all the UCB scores at once.
+
+        :param exploration: The parent's part of the exploration term.
+        """
+        virtual_losses = np.frombuffer(self.child_virtual_losses, dtype=np.int64)
+        visits = np.frombuffer(self.child_visits, dtype=np.int64) + virtual_losses
+        unvisited = visits == 0
+
+        if unvisited.any():
+            return int(unvisited.argmax())
+
+        ucb = (np.frombuffer(self.child_net_wins, dtype=np.int64) - virtual_losses) / visits
+        ucb += exploration / np.sqrt(visits)
+
+        return int(ucb.argmax())
+
+    def select_child(
+        self: Self, state: GameState, trade_off_constant: float
+    ) -> tuple[Self, GameState]:
+        """Select a leaf using the exploration/exploitation trade-off formula.
+
+        The tree is walked down in a loop rather than recursively, so that no Python frame is built
+        per level.
+
+        :param state: The game state associated with this node.
+        :param trade_off_constant: The exploration/exploitation trade-off constant.
+        :return: The selected leaf and its game state.
+        """
+        node = self
+
+        while node.children:
+            index = node.best_child_index(trade_off_constant)
+            child = node.children[index]
+            child.reach_from(node, index)
+            state = node.child_state(index, state)
+            node = child
+
+        return node, state
+
+    def expand(
+        self: Self,
+        state: GameState,
+        transposition_table: Optional[dict[int, Self]] = None,
+    ) -> tuple[Self, GameState]:
+        """Expand this Node by listing all the possible actions and randomly choose a child.
+
+        :param state: The game state associated with this node.
+        :param transposition_table: A dictionary mapping the keys of the states seen so far to their
+          node. If provided and if the state can compute the keys of its children, children whose
+          state was already reached through another sequence of actions share the existing node
+          instead of starting from scratch. The statistics of this node's edges towards them start
+          from those of the shared node. A node that isn't deeper than this one, such as one of its
+          ancestors, is never shared, since it could close a cycle.
+        """
         # If the state is terminal, we don't expand the associated node
-        if state.get_winner() is not None:
+        if state.winner is not None:
             return self, state
 
-        self.actions = state.get_possible_actions()
-        self.children = [_Node(self) for _ in self.actions]
-        chosen_child, chosen_action = choice(list(zip(self.children, self.actions)))
+        self.actions = state.actions
+        child_key = getattr(state, "child_key", None)
+
+        if transposition_table is None or child_key is None:
+            self.children = [_Node(self, index) for index in range(len(self.actions))]
+            self.child_visits = array("q", [0]) * len(self.actions)
+            self.child_net_wins = array("q", [0]) * len(self.actions)
+        else:
+            self.children = []
+
+            for index, action in enumerate(self.actions):
+                key = child_key(action)
+                child = transposition_table.get(key)
+
+                if child is None:
+                    child = transposition_table[key] = _Node(self, index)
+                elif child.depth <= self.depth:
+                    child = _Node(self, index)
+
+                self.children.append(child)
+
+            # Shared children bring along what was already learnt about them
+            self.child_visits = array("q", [child.visits for child in self.children])
+            self.child_net_wins = array("q", [child.net_wins for child in self.children])
 
-        return chosen_child, state.transition(chosen_action)
+        self.child_virtual_losses = array("q", [0]) * len(self.actions)
+        chosen_index = randbelow(len(self.actions))
+        chosen_child = self.children[chosen_index]
+        chosen_child.reach_from(self, chosen_index)
+
+        return chosen_child, self.child_state(chosen_index, state)
 
     @staticmethod
     def rollout(state: GameState) -> int:
@@ -88,39 +261,61 @@ class _Node:
         - 1 if it resulted in a win for the player playing this position;
         - -1 if it resulted in a loss for the player playing this position;
         - 0 if it resulted in a draw.
+
+        The rollout itself is performed by the game state, which may do so more efficiently using
+        its internal representation.
         """
-        new_state = state
-        player = 1
+        return state.rollout()
+
+    @staticmethod
+    def rollout_batch(states: list[GameState]) -> list[int]:
+        """Perform the rollout phase from several states of the same game at once."""
+        return type(states[0]).rollout_batch(states)
+
+    def add_virtual_loss(self: Self, amount: int) -> None:
+        """Add a virtual loss to every node on the path from the root to this node.
 
-        while (winner := new_state.get_winner()) is None:
-            random_action = choice(new_state.get_possible_actions())
-            new_state = new_state.transition(random_action)
-            player *= -1
+        :param amount: The number of virtual losses to add. Use -1 to remove a virtual loss once the
+          simulation going through this node has been backpropagated.
+        """
+        node = self
 
-        return winner * player
+        while (parent := node.parent) is not None:
+            parent.child_virtual_losses[node.index_in_parent] += amount
+            node = parent
 
-    def backpropagate(self: Self, rollout_value: int) -> None:
+    def backpropagate(self: Self, rollout_value: int, n_rollouts: int = 1) -> None:
         """Backpropagate the rollout result through the tree.
 
         This function performs the backpropagation phase of the MCTS algorithm. It updates the value
         of the nodes according to the player playing in their position and the rollout result.
 
         :param rollout_value: The value of the rollout result. It is equal to 1 if the current
-          player won, -1 if the other player won, and 0 in case of a draw.
+          player won, -1 if the other player won, and 0 in case of a draw. If several rollouts were
+          performed from this node, this is the sum of their values.
+        :param n_rollouts: The number of rollouts the result accounts for.
         """
-        self.visits += 1
+        node = self
+
+        # Walk up the parent pointers rather than recursing, so that deep trees neither pay a Python
+        #   frame per level nor hit the recursion limit
+        while node is not None:
+            parent = node.parent
+            index = node.index_in_parent
+
+            node.visits += n_rollouts
 
-        # If the current player wins the rollout, then this node's value must decrease
-        # This is because intuitively, the current player is the adversary of the player that will
-        #   look at this node
-        if rollout_value == -1:
-            self.n_wins += 1
-        elif rollout_value:
-            self.n_defeats += 1
+            # If the current player wins the rollout, then this node's value must decrease
+            # This is because intuitively, the current player is the adversary of the player that
+            #   will look at this node
+            node.net_wins -= rollout_value
 
-        # Unless we're at the root of the tree
-        if self.parent is not None:
-            self.parent.backpropagate(-rollout_value)
+            if parent is not None:
+                parent.child_visits[index] += n_rollouts
+                parent.child_net_wins[index] -= rollout_value
+
+            node = parent
+            rollout_value = -rollout_value
 
     def __repr__(self: Self) -> str:
         value = self.value
@@ -137,6 +332,11 @@ class MCTS:
         state: GameState,
         trade_off_constant: float,
         n_simulations: int,
+        n_workers: int = 1,
+        n_threads: int = 1,
+        batch_size: int = 1,
+        compiled_search: bool = False,
+        n_rollouts: int = 1,
     ) -> None:
         """Initialize the MCTS algorithm.
 
@@ -145,11 +345,30 @@ class MCTS:
         :param state: The state the game starts in.
         :param trade_off_constant: The trade-off constant as used in the UCB formula.
         :param n_simulations: The number of simulations that are performed from the root.
+        :param n_workers: The number of processes the simulations are split across. If larger than
+          1, each process grows its own tree and their root statistics are merged.
+        :param n_threads: The number of threads sharing the tree of each process. If larger than 1,
+          virtual losses are used to make the threads explore different paths.
+        :param batch_size: The number of leaves selected before rolling out from all of them at
+          once. If larger than 1, virtual losses are used to select different leaves.
+        :param compiled_search: If set to True and the game provides its own implementation of the
+          whole search (see `GameState.search`), it is used instead of growing a tree of nodes. The
+          tree is then not kept from one decision to the next, and n_threads, batch_size and
+          n_rollouts are ignored.
+        :param n_rollouts: The number of rollouts performed from each leaf. If larger than 1, they
+          are all performed at once and their results are summed before being backpropagated.
         """
-        _Node.set_trade_off_constant(trade_off_constant)
         self.root = _Node(None)
         self.root_state = state
+        self.transposition_table: dict[int, _Node] = {}
+        self._register_root()
+        self.trade_off_constant = trade_off_constant
         self.n_simulations = n_simulations
+        self.n_workers = n_workers
+        self.n_threads = n_threads
+        self.batch_size = batch_size
+        self.compiled_search = compiled_search
+        self.n_rollouts = n_rollouts
 
     def transition(self: Self, action: Action) -> None:
         """Advance the game with a given action.
@@ -157,11 +376,157 @@ class MCTS:
         This function allows to progress in the game tree without any computation. This may for
         example prove useful if the adversary is exterior to this class.
         """
-        index = self.root.actions.index(action)
-
-        self.root = self.root.children[index]
         self.root_state = self.root_state.transition(action)
 
+        if self.root.is_leaf:
+            # Nothing is known about the resulting state yet, for instance because the simulations
+            #   were run in worker processes
+            self.root = _Node(None)
+            self.transposition_table = {}
+            self._register_root()
+        else:
+            index = self.root.actions.index(action)
+            self.root = self.root.children[index]
+            # Detach the new root so that backpropagation stops there
+            self.root.parent = None
+            self._prune_transposition_table()
+
+    def _register_root(self: Self) -> None:
+        """Add the root to the transposition table, if its state has a key."""
+        key = getattr(self.root_state, "key", None)
+
+        if key is not None:
+            self.transposition_table[key] = self.root
+
+    def _prune_transposition_table(self: Self) -> None:
+        """Remove the nodes that are no longer reachable from the root from the transposition table.
+
+        Otherwise, the table would keep the branches left behind by `transition` alive.
+        """
+        reachable = {self.root}
+        to_visit = [self.root]
+
+        while to_visit:
+            for child in to_visit.pop().children:
+                if child not in reachable:
+                    reachable.add(child)
+                    to_visit.append(child)
+
+        self.transposition_table = {
+            key: node for key, node in self.transposition_table.items() if node in reachable
+        }
+
+    def _simulate(self: Self, n_simulations: int, show_progress: bool = True) -> None:
+        """Perform a given number of simulations from the root, growing the tree along the way."""
+        if self.n_threads > 1 or self.batch_size > 1 or self.n_rollouts > 1:
+            self._simulate_in_batches(n_simulations, show_progress)
+            return
+
+        node = self.root
+        trade_off_constant = self.trade_off_constant
+
+        for _ in trange(n_simulations) if show_progress else range(n_simulations):
+            node, state = node.select_child(self.root_state, trade_off_constant)
+            node, state = node.expand(state, self.transposition_table)
+            rollout_value = node.rollout(state)
+            node.backpropagate(rollout_value)
+            node = self.root
+
+    def _select_leaf(
+        self: Self,
+    ) -> tuple[_Node, GameState, list[tuple[_Node, Optional[_Node], int]]]:
+        """Select and expand a leaf whose rollout is pending, putting a virtual loss on its path.
+
+        :return: The leaf, its state and its path as returned by `_Node.trace`.
+        """
+        node, state = self.root.select_child(self.root_state, self.trade_off_constant)
+        node, state = node.expand(state, self.transposition_table)
+        node.add_virtual_loss(1)
+
+        return node, state, node.trace()
+
+    def _simulate_in_batches(self: Self, n_simulations: int, show_progress: bool) -> None:
+        """Perform the simulations by batches of leaves, possibly with several threads.
+
+        Each batch selects several leaves, rolls out from all of them at once, possibly several
+        times from each, and then backpropagates the results. The path of each pending rollout
+        carries a virtual loss so that the following selections, from the same batch or from other
+        threads, pick different leaves in the meantime. Since they may go through the same
+        transpositions from different parents, the path is recorded to be restored before
+        backpropagating.
+
+        The tree is only modified while holding a lock, which is released during the rollouts. They
+        can then truly run in parallel when they are performed by the compiled functions, which
+        release the GIL.
+        """
+        lock = Lock()
+        n_rollouts = self.n_rollouts
+        progress_bar = tqdm(total=n_simulations, disable=not show_progress)
+
+        def simulate(thread_simulations: int) -> None:
+            while thread_simulations > 0:
+                batch_size = min(self.batch_size, thread_simulations)
+                thread_simulations -= batch_size
+
+                with lock:
+                    leaves = [self._select_leaf() for _ in range(batch_size)]
+
+                rollout_values = _Node.rollout_batch(
+                    [state for _, state, _ in leaves for _ in range(n_rollouts)]
+                )
+
+                with lock:
+                    for i, (node, _, path) in enumerate(leaves):
+                        _Node.restore(path)
+                        node.add_virtual_loss(-1)
+                        node.backpropagate(
+                            sum(rollout_values[i * n_rollouts : (i + 1) * n_rollouts]), n_rollouts
+                        )
+
+                    progress_bar.update(batch_size)
+
+        if self.n_threads == 1:
+            simulate(n_simulations)
+        else:
+            with ThreadPoolExecutor(self.n_threads) as executor:
+                futures = [
+                    executor.submit(simulate, thread_simulations)
+                    for thread_simulations in _split(n_simulations, self.n_threads)
+                ]
+
+                for future in futures:
+                    future.result()
+
+        progress_bar.close()
+
+    def _decide_in_parallel(self: Self) -> Action:
+        """Split the simulations across independent trees and vote on the most visited action.
+
+        Each worker process grows its own tree from the root state. The visit counts of the root's
+        children are then summed across trees, and the action with the largest total is chosen.
+        """
+        with ProcessPoolExecutor(self.n_workers) as executor:
+            futures = [
+                executor.submit(
+                    _run_simulations,
+                    self.root_state,
+                    self.trade_off_constant,
+                    worker_simulations,
+                    getrandbits(32),
+                    n_threads=self.n_threads,
+                    batch_size=self.batch_size,
+                    compiled_search=self.compiled_search,
+                    n_rollouts=self.n_rollouts,
+                )
+                for worker_simulations in _split(self.n_simulations, self.n_workers)
+            ]
+            total_visits: Counter[Action] = Counter()
+
+            for future in futures:
+                total_visits.update(future.result())
+
+        return max(total_visits, key=total_visits.__getitem__)
+
     def decide(self: Self, advance: bool = True) -> Optional[Action]:
         """Decide the next move to be played.
 
@@ -172,20 +537,73 @@ class MCTS:
         :param advance: If set to True, in addition to returning the best action, the root will be
           set to the child corresponding to this action.
         """
-        node = self.root
+        if self.n_workers > 1:
+            chosen_action = self._decide_in_parallel()
+        else:
+            visits = None
 
-        for _ in trange(self.n_simulations):
-            node, state = node.select_child(self.root_state)
-            node, state = node.expand(state)
-            rollout_value = node.rollout(state)
-            node.backpropagate(rollout_value)
-            node = self.root
+            if self.compiled_search:
+                visits = self.root_state.search(self.trade_off_constant, self.n_simulations)
+
+            if visits is not None:
+                chosen_action = self.root_state.actions[int(np.argmax(visits))]
+            else:
+                self._simulate(self.n_simulations)
 
-        chosen_action = self.root.actions[
-            max(enumerate(self.root.children), key=lambda x: x[1].visits)[0]
-        ]
+                # Use the root's own statistics of its children rather than the children's visits,
+                #   which also grow when a child shared through a transposition is visited from
+                #   elsewhere
+                chosen_index = int(np.argmax(self.root.child_visits))
+                chosen_action = self.root.actions[chosen_index]
 
         if advance:
             self.transition(chosen_action)
 
         return chosen_action
+
+
+def _split(n_simulations: int, n_parts: int) -> list[int]:
+    """Split a number of simulations into as evenly sized parts as possible."""
+    return [n_simulations // n_parts + (i < n_simulations % n_parts) for i in range(n_parts)]
+
+
+def _run_simulations(
+    state: GameState,
+    trade_off_constant: float,
+    n_simulations: int,
+    random_seed: int,
+    n_threads: int = 1,
+    batch_size: int = 1,
+    compiled_search: bool = False,
+    n_rollouts: int = 1,
+) -> dict[Action, int]:
+    """Grow a fresh tree from a state and return the visits of the root's children.
+
+    This function is run in the worker processes used by root parallelization. Every random
+    generator is reseeded so that the workers don't all grow the same tree. The remaining
+    parameters are those of `MCTS`, so that each worker searches the way a single process would.
+
+    :return: A dictionary mapping each action of the root to the visits of the corresponding child.
+    """
+    seed(random_seed)
+    np.random.seed(random_seed)
+    type(state).seed_rollouts(random_seed)
+
+    if compiled_search:
+        visits = state.search(trade_off_constant, n_simulations)
+
+        if visits is not None:
+            return dict(zip(state.actions, visits))
+
+    mcts = MCTS(
+        state,
+        trade_off_constant,
+        n_simulations,
+        n_threads=n_threads,
+        batch_size=batch_size,
+        compiled_search=compiled_search,
+        n_rollouts=n_rollouts,
+    )
+    mcts._simulate(n_simulations, show_progress=False)
+
+    return dict(zip(mcts.root.actions, mcts.root.child_visits.tolist()))
@@ -1,78 +1,381 @@
+from collections.abc import Callable
 from typing import Self, Optional
 
 import numpy as np
 import numpy.typing as npt
 
 from action import Action
-from game_state import GameState
+from game_state import GameState, randbelow
+
+try:
+    from numba import njit
+
+    # Compiled functions draw their random numbers from Numba's own generator
+    _random_below = np.random.randint
+except ImportError:
+    # Without Numba, the functions below are simply run by the Python interpreter
+    def njit(*args: object, **kwargs: object) -> Callable[[Callable], Callable]:
+        """Return a decorator leaving the function untouched."""
+        return lambda function: function
+
+    _random_below = randbelow
+
+
+# Masks of the squares forming the 8 winning lines. The square in row y and column x is represented
+#   by bit 3 * y + x
+WIN_MASKS: tuple[int, ...] = (
+    0b000_000_111,
+    0b000_111_000,
+    0b111_000_000,
+    0b001_001_001,
+    0b010_010_010,
+    0b100_100_100,
+    0b100_010_001,
+    0b001_010_100,
+)
+FULL_BOARD: int = 0b111_111_111
+
+# Bits of the first square of each row and of each column. Shifting a bitboard by 1 and 2 (resp. 3
+#   and 6) aligns the squares of every row (resp. column) on these bits, so that all the rows (resp.
+#   columns) are checked at once
+ROW_STARTS: int = 0b001_001_001
+COLUMN_STARTS: int = 0b000_000_111
+DIAGONAL: int = WIN_MASKS[6]
+ANTI_DIAGONAL: int = WIN_MASKS[7]
+
+# Value returned by _check_winner when the game isn't over
+NOT_OVER: int = 2
+
+# POPCOUNT[empty] is the number of set bits of a bitboard, and SELECT_TABLE[empty, k] is its k-th
+#   lowest set bit, so that a random empty square is drawn with two lookups
+POPCOUNT: npt.NDArray[np.int64] = np.array(
+    [empty.bit_count() for empty in range(FULL_BOARD + 1)], dtype=np.int64
+)
+SELECT_TABLE: npt.NDArray[np.int64] = np.array(
+    [
+        [1 << square for square in range(9) if empty >> square & 1] + [0] * (9 - POPCOUNT[empty])
+        for empty in range(FULL_BOARD + 1)
+    ],
+    dtype=np.int64,
+)
+
+
+# The functions below are compiled by Numba and the result is cached on disk. Those with an explicit
+#   signature are compiled eagerly, when the module is imported. _grown works on arrays of any type,
+#   so it is compiled lazily, once per type it is called with.
+
+
+@njit("int64(int64, int64)", cache=True)
+def _legal_moves_bitboard(us: int, them: int) -> int:
+    """Return the bitboard of the empty squares."""
+    return FULL_BOARD & ~(us | them)
+
+
+@njit("int8(int64, int64)", cache=True)
+def _check_winner(us: int, them: int) -> int:
+    """Return the winner of the game, as in `GameState.get_winner`, or NOT_OVER."""
+    # Only the player that just played may have completed a line
+    rows = them & them >> 1 & them >> 2 & ROW_STARTS
+    columns = them & them >> 3 & them >> 6 & COLUMN_STARTS
+    diagonals = (them & DIAGONAL == DIAGONAL) | (them & ANTI_DIAGONAL == ANTI_DIAGONAL)
+
+    if rows | columns | diagonals:
+        return -1
+
+    if us | them == FULL_BOARD:
+        return 0
+
+    return NOT_OVER
+
+
+@njit("int64(int64)", cache=True)
+def _random_empty_square(empty: int) -> int:
+    """Return the bit of a random empty square, given the bitboard of the empty squares."""
+    # The conversions are only there for the interpreter, when Numba isn't available
+    return int(SELECT_TABLE[empty, _random_below(int(POPCOUNT[empty]))])
+
+
+@njit("int8(int64, int64)", cache=True, nogil=True)
+def rollout_from(us: int, them: int) -> int:
+    """Randomly play a game from the given bitboards until it ends.
+
+    :param us: The bitboard of the player whose turn it is.
+    :param them: The bitboard of the other player.
+    :return: 1 if the player whose turn it is won, -1 if they lost and 0 in case of a draw.
+    """
+    sign = 1
+
+    while True:
+        winner = _check_winner(us, them)
+        if winner != NOT_OVER:
+            return winner * sign
+
+        # The turn changes hands, so the bitboards are swapped
+        us, them = them, us | _random_empty_square(_legal_moves_bitboard(us, them))
+        sign = -sign
+
+
+@njit("int8[:](int64[:], int64[:])", cache=True, nogil=True)
+def rollout_batch_from(
+    us: npt.NDArray[np.int64], them: npt.NDArray[np.int64]
+) -> npt.NDArray[np.int8]:
+    """Randomly play several games until they end.
+
+    :param us: The bitboards of the players whose turn it is, one per game.
+    :param them: The bitboards of the other players, one per game.
+    :return: The result of each game, as returned by `rollout_from`.
+    """
+    results = np.empty(us.shape[0], dtype=np.int8)
+
+    for i in range(us.shape[0]):
+        results[i] = rollout_from(us[i], them[i])
+
+    return results
+
+
+@njit(cache=True)
+def _grown(array: npt.NDArray) -> npt.NDArray:
+    """Return a copy of an array with twice its capacity."""
+    new_array = np.empty(2 * array.shape[0], dtype=array.dtype)
+    new_array[: array.shape[0]] = array
+
+    return new_array
+
+
+@njit("int64[:](int64, int64, int64, float64)", cache=True, nogil=True)
+def search_from(us: int, them: int, n_simulations: int, trade_off_constant: float) -> npt.NDArray:
+    """Run a whole MCTS from the given bitboards.
+
+    The tree is stored as a pool of nodes identified by their index, with one array per statistic.
+    The children of a node are contiguous in the pool and sorted by square, so that they are in the
+    same order as the actions returned by `TicTacToeGameState.get_possible_actions`. The bitboards
+    of a node aren't stored, but recomputed from the squares played while walking down the tree.
+
+    :param us: The bitboard of the player whose turn it is at the root.
+    :param them: The bitboard of the other player.
+    :param n_simulations: The number of simulations that are performed from the root.
+    :param trade_off_constant: The trade-off constant as used in the UCB formula.
+    :return: The visits of the root's children, or an empty array if the root is terminal.
+    """
+    capacity = 1024
+    parents = np.empty(capacity, dtype=np.int32)
+    # Square played to reach the node
+    squares = np.empty(capacity, dtype=np.int8)
+    visits = np.zeros(capacity, dtype=np.int32)
+    # Wins minus defeats, from the point of view of the player choosing the node
+    net_wins = np.zeros(capacity, dtype=np.int32)
+    # Index of the first child, or -1 if the node isn't expanded
+    first_child = np.full(capacity, -1, dtype=np.int32)
+    n_children = np.zeros(capacity, dtype=np.int8)
+
+    parents[0] = -1
+    n_nodes = 1
+
+    for _ in range(n_simulations):
+        node = 0
+        node_us, node_them = us, them
+
+        # Selection
+        while first_child[node] != -1:
+            first = first_child[node]
+            exploration = trade_off_constant * np.sqrt(np.log(max(visits[node], 1)))
+            best_child = first
+            best_ucb = -np.inf
+
+            for child in range(first, first + n_children[node]):
+                # Unvisited children are always selected first
+                if visits[child] == 0:
+                    best_child = child
+                    break
+
+                ucb = net_wins[child] / visits[child] + exploration / np.sqrt(visits[child])
+
+                if ucb > best_ucb:
+                    best_child = child
+                    best_ucb = ucb
+
+            node = best_child
+            node_us, node_them = node_them, node_us | 1 << int(squares[node])
+
+        # Expansion, unless the state is terminal
+        if _check_winner(node_us, node_them) == NOT_OVER:
+            if n_nodes + 9 > capacity:
+                parents = _grown(parents)
+                squares = _grown(squares)
+                visits = _grown(visits)
+                net_wins = _grown(net_wins)
+                first_child = _grown(first_child)
+                n_children = _grown(n_children)
+                visits[capacity:] = 0
+                net_wins[capacity:] = 0
+                first_child[capacity:] = -1
+                capacity *= 2
+
+            first = n_nodes
+            empty = _legal_moves_bitboard(node_us, node_them)
+
+            for square in range(9):
+                if empty >> square & 1:
+                    parents[n_nodes] = node
+                    squares[n_nodes] = square
+                    n_nodes += 1
+
+            first_child[node] = first
+            n_children[node] = n_nodes - first
+            node = first + _random_below(n_nodes - first)
+            node_us, node_them = node_them, node_us | 1 << int(squares[node])
+
+        # Rollout
+        rollout_value = rollout_from(node_us, node_them)
+
+        # Backpropagation
+        while node != -1:
+            visits[node] += 1
+            # The node is chosen by the adversary of the player whose turn it is there
+            net_wins[node] -= rollout_value
+            node = parents[node]
+            rollout_value = -rollout_value
+
+    if first_child[0] == -1:
+        return np.empty(0, dtype=np.int64)
+
+    return visits[first_child[0] : first_child[0] + n_children[0]].astype(np.int64)
+
+
+@njit("void(int64)", cache=True)
+def _seed(value: int) -> None:
+    """Seed the random generator used by the compiled functions, which is not NumPy's."""
+    np.random.seed(value)
 
 
 class TicTacToeAction(Action):
     """A Tic-Tac-Toe action."""
 
+    __slots__ = ("square", "x", "y")
+
     def __init__(self: Self, x: int, y: int) -> None:
         """Initialize the action."""
         self.x = x
         self.y = y
+        # Index of the bit representing the square of this action, which is all the bitboards need
+        self.square = 3 * y + x
 
     def __eq__(self: Self, other: Self):
         return self.x == other.x and self.y == other.y
 
     def __hash__(self: Self):
-        return 3 * self.x + self.y
+        return self.square
 
     def __repr__(self: Self) -> str:
         """Return a string representation of the action."""
         return f"Action({self.x}, {self.y})"
 
 
+# ACTIONS_TABLE[empty] holds the actions playing on the empty squares of a bitboard, sorted by
+#   square. Actions are never modified, so they are built once here and shared by every state
+ACTIONS_TABLE: tuple[tuple[TicTacToeAction, ...], ...] = tuple(
+    tuple(TicTacToeAction(square % 3, square // 3) for square in range(9) if empty >> square & 1)
+    for empty in range(FULL_BOARD + 1)
+)
+
+
 class TicTacToeGameState(GameState):
     """A Tic-Tac-Toe game state."""
 
-    def __init__(
-        self: Self, initial_state: Optional[npt.NDArray[np.int8]] = None
-    ) -> None:
-        """Initialize the game state."""
-        if initial_state is None:
-            self.board: npt.NDArray[np.int8] = np.zeros((3, 3), dtype=np.int8)
-        else:
-            if initial_state.shape != (3, 3):
-                raise ValueError(
-                    "Wrong shape provided for initial state. "
-                    f"Expected (3,3) and got {initial_state.shape}"
-                )
+    __slots__ = ("them", "us")
 
-            self.board = initial_state
+    def __init__(self: Self, us: int = 0, them: int = 0) -> None:
+        """Initialize the game state.
 
-    def get_winner(self: Self) -> Optional[int]:
-        check_col = self.board.sum(axis=0)
-        check_row = self.board.sum(axis=1)
-        check_diag = np.trace(self.board)
-        check_anti_diag = np.trace(np.fliplr(self.board))
+        The board is represented by two bitboards, one per player, where bit 3 * y + x is set if the
+        player has a piece in row y and column x.
+
+        :param us: The bitboard of the player whose turn it is.
+        :param them: The bitboard of the other player.
+        """
+        self.us = us
+        self.them = them
+
+    @classmethod
+    def from_board(cls: type(Self), board: npt.NDArray[np.int8]) -> Self:
+        """Create a game state from a 3x3 board.
+
+        :param board: The board, with 1 for the pieces of the player whose turn it is, -1 for those
+          of the other player and 0 for empty squares.
+        """
+        if board.shape != (3, 3):
+            raise ValueError(
+                f"Wrong shape provided for initial state. Expected (3,3) and got {board.shape}"
+            )
+
+        us = them = 0
+
+        for square, piece in enumerate(board.flat):
+            if piece == 1:
+                us |= 1 << square
+            elif piece == -1:
+                them |= 1 << square
+
+        return cls(us, them)
 
-        if -3 in check_col or -3 in check_row or check_diag == -3 or check_anti_diag == -3:
-            return -1
+    @property
+    def key(self: Self) -> int:
+        """Return an integer identifying the board, used as key of the transposition table.
 
-        if 0 not in self.board:
-            return 0
+        Both bitboards fit in 9 bits, so they are simply packed side by side. Unlike a hash, two
+        different boards can't share the same key.
+        """
+        return self.us | self.them << 9
+
+    def child_key(self: Self, action: TicTacToeAction) -> int:
+        """Return the key of the state resulting from the given action, without building it."""
+        return self.them | (self.us | 1 << action.square) << 9
+
+    def get_winner(self: Self) -> Optional[int]:
+        winner = _check_winner(self.us, self.them)
+
+        if winner != NOT_OVER:
+            return int(winner)
 
     def get_possible_actions(self: Self) -> list[Action]:
-        return [
-            TicTacToeAction(int(y), int(x)) for x, y in np.argwhere(self.board == 0)
-        ]
+        return list(ACTIONS_TABLE[FULL_BOARD & ~(self.us | self.them)])
 
     def transition(self: Self, action: TicTacToeAction) -> Self:
-        new_state = TicTacToeGameState(self.board.copy())
-        new_state.board[action.y, action.x] = 1
-        new_state.board *= -1
+        # The turn changes hands, so the bitboards are swapped
+        return TicTacToeGameState(self.them, self.us | 1 << action.square)
+
+    def rollout(self: Self) -> int:
+        """Randomly play until the game ends, directly on the bitboards."""
+        return int(rollout_from(self.us, self.them))
 
-        return new_state
+    @classmethod
+    def rollout_batch(cls: type(Self), states: list[Self]) -> list[int]:
+        """Perform a rollout from each of the given states with a single call."""
+        us = np.array([state.us for state in states], dtype=np.int64)
+        them = np.array([state.them for state in states], dtype=np.int64)
+
+        return rollout_batch_from(us, them).tolist()
+
+    @classmethod
+    def seed_rollouts(cls: type(Self), value: int) -> None:
+        """Seed the random generators used by the rollouts."""
+        super().seed_rollouts(value)
+        _seed(value)
+
+    def search(self: Self, trade_off_constant: float, n_simulations: int) -> list[int]:
+        """Run a whole MCTS from this state with the compiled `search_from`."""
+        return search_from(self.us, self.them, n_simulations, trade_off_constant).tolist()
 
     def __repr__(self: Self) -> str:
         """Return a string representation of the game state."""
-        res = ""
-        for row in self.board:
-            res += "|".join(("X" if x == 1 else "O") if x else " " for x in row) + "\n"
+        rows = []
+        for y in range(3):
+            squares = (3 * y + x for x in range(3))
+            rows.append(
+                "|".join(
+                    "X" if self.us >> square & 1 else "O" if self.them >> square & 1 else " "
+                    for square in squares
+                )
+            )
 
-        # Remove last \n
-        return res[:-1]
+        return "\n".join(rows)